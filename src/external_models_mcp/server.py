@@ -1,21 +1,69 @@
+from __future__ import annotations
+
 from mcp.server.fastmcp import FastMCP
-import litellm
+import httpx
+import asyncio
+import codecs
+import contextlib
+import functools
+import hashlib
+import io
+import mmap
 import os
+import stat
 import sys
-from typing import List, Optional
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
 from dotenv import load_dotenv
 from pathlib import Path
 
 # Load environment variables
 load_dotenv()
 
-# Set keys
-litellm.api_key = os.environ.get("OPENROUTER_API_KEY")
-litellm.groq_api_key = os.environ.get("GROQ_API_KEY")
-litellm.huggingface_api_key = os.environ.get("HUGGINGFACE_API_KEY")
+# Pooled HTTP client for LiteLLM, owned by the server lifespan
+_http_client: Optional[httpx.AsyncClient] = None
+
+@functools.cache
+def _get_litellm():
+    """
+    Imports and configures LiteLLM on first use.
+    It pulls in every provider SDK, so importing it eagerly would slow down server startup.
+    """
+    import litellm
+
+    # Set keys
+    litellm.api_key = os.environ.get("OPENROUTER_API_KEY")
+    litellm.groq_api_key = os.environ.get("GROQ_API_KEY")
+    litellm.huggingface_api_key = os.environ.get("HUGGINGFACE_API_KEY")
+    litellm.aclient_session = _http_client
+    return litellm
+
+def _set_http_client(client: Optional[httpx.AsyncClient]) -> None:
+    global _http_client
+    _http_client = client
+    # Only hand it to LiteLLM if it is already loaded, otherwise _get_litellm picks it up
+    if "litellm" in sys.modules:
+        sys.modules["litellm"].aclient_session = client
+
+@contextlib.asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """Shares one pooled HTTP client across LiteLLM calls for the life of the server."""
+    # Keep-alive connections let repeated calls skip the TCP + TLS handshake
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=httpx.Timeout(60, connect=10),
+    )
+    _set_http_client(client)
+    try:
+        yield
+    finally:
+        _set_http_client(None)
+        await client.aclose()
 
 # Initialize MCP
-mcp = FastMCP("External Brain")
+mcp = FastMCP("External Brain", lifespan=_lifespan)
 
 # --- CONFIGURATION ---
 
@@ -30,108 +78,430 @@ MODEL_ALIASES = {
     "hf-kimi": "huggingface/moonshotai/Kimi-K2-Instruct-0905",
 }
 
+DEFAULT_EXPERTS = ("kimi-k2", "hf-glm")
+
+# Static system prompt prefixes, only the context is spliced in per call
+_ASK_SYS_PREFIX = "You are an expert software engineer. Below is the relevant project context provided in XML format:\n\n"
+_DRAFT_SYS_PREFIX = (
+    "You are an elite software engineer. You are rewriting a file to meet user requirements.\n"
+    "Output ONLY the new content of the file. Do not output markdown code fences. Do not output conversational text.\n"
+    "Additional Context from other files:\n"
+)
+
+# Normalized once at import, read-only lookup for _resolve_model_name
+_MODEL_ALIASES_LC = types.MappingProxyType(
+    {alias.lower(): sys.intern(model) for alias, model in MODEL_ALIASES.items()}
+)
+
 # Safety Limits
 MAX_FILE_SIZE_BYTES = 512 * 1024 
 MAX_TOTAL_CHARS = 400000     
+_FILE_XML_OVERHEAD = len("<file path=''>\n\n</file>")
+_READ_CHUNK_BYTES = 64 * 1024
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0)
+
+# Concurrency Limits (in-flight requests per provider, to stay within RPM budgets)
+PROVIDER_CONCURRENCY = {
+    "groq": 5,
+    "openrouter": 3,
+    "huggingface": 2,
+}
+DEFAULT_PROVIDER_CONCURRENCY = 5
+MAX_READ_WORKERS = 16
+PARALLEL_READ_MIN_FILES = 8
+_PROVIDER_SEMAPHORES: dict[str, asyncio.Semaphore] = {}
+
+# Rate Limit Backoff
+RATE_LIMIT_MAX_ATTEMPTS = 6
+RATE_LIMIT_MAX_BACKOFF_SECONDS = 30
+
+# Response Cache
+RESPONSE_CACHE_DIR = Path.home() / ".cache" / "external_models_mcp"
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+_last_cache_prune = 0.0
 
 def _resolve_model_name(alias: str) -> str:
-    clean_alias = alias.lower().strip()
-    return MODEL_ALIASES.get(clean_alias, alias)
+    return _MODEL_ALIASES_LC.get(alias.strip().lower(), alias)
+
+@functools.lru_cache(maxsize=256)
+def _load_file_text(path: str, mtime_ns: int, size: int) -> Optional[str]:
+    """
+    Decodes a context file, or returns None if it looks binary.
+    Cached on (path, mtime_ns, size) so unchanged files are only read once per process.
+    """
+    fd = os.open(path, _OPEN_FLAGS)
+    try:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            # Skip binary files (quick check)
+            if mm.find(b"\0", 0, 1024) != -1:
+                return None
 
-def _read_context_files(file_paths: List[str]) -> str:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            # Decode straight from the mapping, no intermediate bytes copy
+            return str(mm, "utf-8", "replace")
+    finally:
+        os.close(fd)
+
+def _read_unsized_file(path: str) -> Optional[str]:
+    """
+    Reads a file that reports a size of 0 (empty, or a pseudo file like /proc/*).
+    These can't be mapped or trusted to stay unchanged, so they are decoded
+    chunk by chunk, stopping as soon as they exceed the size limit.
+    """
+    with open(path, "rb", buffering=0) as f:
+        head = f.read(1024)
+        # Most of these are simply empty, nothing more to do
+        if not head:
+            return ""
+        # Skip binary files (quick check)
+        if head.find(b"\0") != -1:
+            return None
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        parts = [decoder.decode(head)]
+        bytes_read = len(head)
+        # One buffer is reused for every further chunk instead of allocating a bytes object per read
+        chunk = bytearray(_READ_CHUNK_BYTES)
+        view = memoryview(chunk)
+        while n := f.readinto(chunk):
+            bytes_read += n
+            if bytes_read > MAX_FILE_SIZE_BYTES:
+                raise ValueError("File too large (exceeds 512KB)")
+            parts.append(decoder.decode(view[:n]))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+def _process_one_file(path_str: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Stats and loads a single context file.
+    Returns None for files to skip silently, otherwise (display path, content, error).
+    """
+    try:
+        # A single stat tells us existence, type and size before we open anything
+        try:
+            st = os.stat(path_str)
+        except FileNotFoundError:
+            print(f"[Warning] File not found: {Path(path_str).resolve()}", file=sys.stderr)
+            return None
+        
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        # Resolved once, only for the path shown to the model
+        path = str(Path(path_str).resolve())
+
+        # Size check
+        if st.st_size > MAX_FILE_SIZE_BYTES:
+            return path, None, "File too large (exceeds 512KB)"
+
+        if st.st_size == 0:
+            content = _read_unsized_file(path)
+        else:
+            content = _load_file_text(path, st.st_mtime_ns, st.st_size)
+        if content is None:
+            print(f"[Warning] Skipping binary file: {path}", file=sys.stderr)
+            return path, None, "Skipped binary file"
+        return path, content, None
+        
+    except Exception as e:
+        return path_str, None, str(e)
+
+@functools.cache
+def _get_read_executor() -> ThreadPoolExecutor:
+    """Shared pool for context file reads, created on first use and reused across calls."""
+    return ThreadPoolExecutor(max_workers=MAX_READ_WORKERS, thread_name_prefix="context-read")
+
+def _read_context_files(file_paths: Sequence[str]) -> str:
     """Reads files and wraps them in XML tags for better model parsing."""
-    context_parts = []
+    if not file_paths:
+        return ""
+
+    buf = io.StringIO()
     total_chars = 0
-    
-    for path_str in file_paths:
-        try:
-            path = Path(path_str).resolve()
-            
-            if not path.exists():
-                print(f"[Warning] File not found: {path}", file=sys.stderr)
-                continue
-            
-            if not path.is_file():
-                continue
 
-            # Skip binary files (quick check)
-            with path.open("rb") as f:
-                if b"\0" in f.read(1024):
-                    print(f"[Warning] Skipping binary file: {path}", file=sys.stderr)
-                    context_parts.append(f"<error file='{path}'>Skipped binary file</error>")
-                    continue
+    def _emit(*fragments: str) -> None:
+        # Parts are separated by a blank line
+        if buf.tell():
+            buf.write("\n\n")
+        for fragment in fragments:
+            buf.write(fragment)
 
-            # Size check
-            if path.stat().st_size > MAX_FILE_SIZE_BYTES:
-                context_parts.append(f"<error file='{path}'>File too large (exceeds 512KB)</error>")
-                continue
+    # A handful of files (usually cache hits costing one stat) is cheaper to read inline.
+    # Larger batches go to the shared pool (the GIL is released around the I/O), but are
+    # assembled in order so the context limit applies exactly as before.
+    if len(file_paths) < PARALLEL_READ_MIN_FILES:
+        futures = []
+        results = map(_process_one_file, file_paths)
+    else:
+        futures = [_get_read_executor().submit(_process_one_file, p) for p in file_paths]
+        results = (future.result() for future in futures)
 
-            content = path.read_text(encoding="utf-8", errors="replace")
-            
-            # Total context limit check
-            if total_chars + len(content) > MAX_TOTAL_CHARS:
-                context_parts.append(f"<error file='{path}'>Context limit reached. File truncated.</error>")
-                break
-
-            # Wrap in XML
-            file_xml = f"<file path='{path}'>\n{content}\n</file>"
-            context_parts.append(file_xml)
-            total_chars += len(file_xml)
-            
-        except Exception as e:
-            context_parts.append(f"<error file='{path_str}'>{str(e)}</error>")
+    for result in results:
+        if result is None:
+            continue
+        path, content, error = result
+        if error is not None:
+            _emit(f"<error file='{path}'>{error}</error>")
+            continue
+        
+        # Total context limit check
+        if total_chars + len(content) > MAX_TOTAL_CHARS:
+            _emit(f"<error file='{path}'>Context limit reached. File truncated.</error>")
+            # Nothing after this point is used, don't start any more reads
+            for future in futures:
+                future.cancel()
+            break
+
+        # Wrap in XML, writing the pieces straight into the buffer
+        _emit("<file path='", path, "'>\n", content, "\n</file>")
+        total_chars += _FILE_XML_OVERHEAD + len(path) + len(content)
             
-    return "\n\n".join(context_parts)
+    return buf.getvalue()
 
-@mcp.tool()
-def ask_expert(prompt: str, model: str = "kimi-k2", context_files: List[str] = []) -> str:
-    """
-    Query an external 'Coding Expert' model with project context.
-    
-    Args:
-        prompt: The task or question.
-        model: Alias (e.g. 'kimi-k2', 'hf-glm', 'minimax'). Defaults to 'kimi-k2' (Groq).
-        context_files: List of absolute file paths to include as context.
-    """
-    resolved_model = _resolve_model_name(model)
-    print(f"[External Brain] Model: {resolved_model}", file=sys.stderr)
-    
-    # 1. Build Context
-    context_xml = _read_context_files(context_files)
-    
-    # 2. Structure the prompt
+def _build_messages(prompt: str, context_xml: str) -> List[dict]:
+    """Builds the chat messages for an expert query."""
     # We use a system message for context to keep it separated from the user's task
     messages = []
     
     if context_xml:
         messages.append({
             "role": "system", 
-            "content": f"You are an expert software engineer. Below is the relevant project context provided in XML format:\n\n{context_xml}"
+            "content": _ASK_SYS_PREFIX + context_xml
         })
     
     messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _response_cache_key(model: str, temperature: float, messages: List[dict]) -> str:
+    """Hashes everything that determines a model's answer into a cache key."""
+    digest = hashlib.sha256(f"{model}\0{temperature}".encode("utf-8"))
+    for message in messages:
+        digest.update(f"\0{message['role']}\0".encode("utf-8"))
+        digest.update(message["content"].encode("utf-8"))
+    return digest.hexdigest()
+
+def _response_cache_enabled() -> bool:
+    """The cache can be turned off entirely with EXTERNAL_MODELS_NO_CACHE=1."""
+    return os.environ.get("EXTERNAL_MODELS_NO_CACHE", "").strip().lower() not in ("1", "true", "yes")
+
+def _get_cached_response(key: str) -> Optional[str]:
+    cache_path = RESPONSE_CACHE_DIR / f"{key}.txt"
+    try:
+        if time.time() - cache_path.stat().st_mtime > RESPONSE_CACHE_TTL_SECONDS:
+            cache_path.unlink(missing_ok=True)
+            return None
+        return cache_path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+
+def _prune_response_cache() -> None:
+    """
+    Deletes expired entries and orphaned temp files so the cache directory doesn't
+    grow without bound. Scans on the first write and then at most once per TTL.
+    """
+    global _last_cache_prune
+    now = time.time()
+    if now - _last_cache_prune < RESPONSE_CACHE_TTL_SECONDS:
+        return
+    _last_cache_prune = now
+    cutoff = now - RESPONSE_CACHE_TTL_SECONDS
+    with os.scandir(RESPONSE_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.name.endswith((".txt", ".tmp")) and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                continue
 
+def _put_cached_response(key: str, content: str) -> None:
+    cache_path = RESPONSE_CACHE_DIR / f"{key}.txt"
     try:
-        response = litellm.completion(
+        RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write a sibling first so concurrent readers never see a partial entry
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(content, encoding="utf-8")
+        os.replace(tmp_path, cache_path)
+        _prune_response_cache()
+    except OSError as e:
+        print(f"[Warning] Could not cache response: {e}", file=sys.stderr)
+
+def _provider_semaphore(resolved_model: str) -> asyncio.Semaphore:
+    """Returns the process-wide semaphore bounding in-flight requests to a provider."""
+    provider = resolved_model.split("/", 1)[0]
+    semaphore = _PROVIDER_SEMAPHORES.get(provider)
+    if semaphore is None:
+        limit = PROVIDER_CONCURRENCY.get(provider, DEFAULT_PROVIDER_CONCURRENCY)
+        semaphore = _PROVIDER_SEMAPHORES[provider] = asyncio.Semaphore(limit)
+    return semaphore
+
+def _rate_limit_delay(error: Exception, attempt: int) -> float:
+    """Honors the provider's Retry-After header, otherwise backs off exponentially."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        delay = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        delay = 2 ** (attempt - 1)
+    return min(delay, RATE_LIMIT_MAX_BACKOFF_SECONDS)
+
+async def _acompletion_with_backoff(**kwargs):
+    """Calls litellm.acompletion, retrying with backoff while the provider rate limits us."""
+    litellm = _get_litellm()
+    for attempt in range(1, RATE_LIMIT_MAX_ATTEMPTS + 1):
+        try:
+            return await litellm.acompletion(**kwargs)
+        except litellm.RateLimitError as e:
+            if attempt == RATE_LIMIT_MAX_ATTEMPTS:
+                raise
+            delay = _rate_limit_delay(e, attempt)
+            print(f"[External Brain] {kwargs['model']} rate limited, retrying in {delay:g}s", file=sys.stderr)
+            await asyncio.sleep(delay)
+
+async def _run_completion(
+    model: str,
+    messages: List[dict],
+    use_cache: bool = True,
+    allow_partial: bool = True,
+) -> str:
+    """
+    Sends prepared messages to an expert model without blocking the event loop.
+    If the stream breaks mid-answer, the partial text is returned with an error note,
+    unless allow_partial is False, in which case the error is raised. An empty answer
+    is also treated as an error when allow_partial is False.
+    """
+    resolved_model = _resolve_model_name(model)
+    temperature = 0.2 # Lower temperature for better coding accuracy
+
+    cache_key = _response_cache_key(resolved_model, temperature, messages)
+    use_cache = use_cache and _response_cache_enabled()
+    cached = _get_cached_response(cache_key) if use_cache else None
+    if cached is not None:
+        print(f"[External Brain] Model: {resolved_model} (cached)", file=sys.stderr)
+        return cached
+
+    print(f"[External Brain] Model: {resolved_model}", file=sys.stderr)
+    async with _provider_semaphore(resolved_model):
+        response = await _acompletion_with_backoff(
             model=resolved_model,
             messages=messages,
-            temperature=0.2 # Lower temperature for better coding accuracy
+            temperature=temperature,
+            stream=True
         )
-        return response.choices[0].message.content
+
+        # Assemble tokens as they arrive and echo them to stderr for progress feedback.
+        # Echo whole lines tagged with the model, so concurrent experts don't interleave.
+        buf = io.StringIO()
+        pending = []
+        try:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                piece = chunk.choices[0].delta.content
+                if piece:
+                    buf.write(piece)
+                    *lines, rest = piece.split("\n")
+                    if lines:
+                        lines[0] = "".join(pending) + lines[0]
+                        pending.clear()
+                        sys.stderr.write("".join(f"[{resolved_model}] {line}\n" for line in lines))
+                    if rest:
+                        pending.append(rest)
+        except Exception as e:
+            partial = buf.getvalue()
+            if not partial or not allow_partial:
+                raise
+            # Keep what we already received rather than losing the whole answer
+            return f"{partial}\n\n[Error using {resolved_model}: stream interrupted: {str(e)}]"
+        finally:
+            if pending:
+                sys.stderr.write(f"[{resolved_model}] {''.join(pending)}\n")
+
+    content = buf.getvalue()
+    if not content and not allow_partial:
+        raise ValueError("empty response")
+    if content and _response_cache_enabled():
+        # Still stored when use_cache=False, so a fresh answer replaces the old one
+        _put_cached_response(cache_key, content)
+    return content
+
+def _format_expert_result(alias: str, result) -> str:
+    """Formats one expert's answer (or failure) as a markdown section."""
+    if isinstance(result, Exception):
+        result = f"Error using {_resolve_model_name(alias)}: {str(result)}"
+    return f"## Expert: {alias.upper()}\n\n{result}\n"
+
+@mcp.tool()
+async def ask_expert(
+    prompt: str,
+    model: str = "kimi-k2",
+    context_files: Optional[List[str]] = None,
+    use_cache: bool = True,
+) -> str:
+    """
+    Query an external 'Coding Expert' model with project context.
+    
+    Args:
+        prompt: The task or question.
+        model: Alias (e.g. 'kimi-k2', 'hf-glm', 'minimax'). Defaults to 'kimi-k2' (Groq).
+        context_files: List of absolute file paths to include as context.
+        use_cache: Set to False to get a fresh answer instead of a cached one.
+    """
+    context_files = context_files or ()
+    messages = _build_messages(prompt, _read_context_files(context_files))
+    try:
+        return await _run_completion(model, messages, use_cache=use_cache)
     except Exception as e:
-        return f"Error using {resolved_model}: {str(e)}"
+        return f"Error using {_resolve_model_name(model)}: {str(e)}"
 
 @mcp.tool()
-def compare_experts(prompt: str, context_files: List[str] = [], experts: List[str] = ["kimi-k2", "hf-glm"]) -> str:
+async def compare_experts(
+    prompt: str,
+    context_files: Optional[List[str]] = None,
+    experts: Optional[List[str]] = None,
+    fastest_response: bool = False,
+    use_cache: bool = True,
+) -> str:
     """
     Get and compare coding solutions from two different experts.
+    The experts are queried concurrently.
+
+    Args:
+        prompt: The task or question.
+        context_files: List of absolute file paths to include as context.
+        experts: Expert aliases to consult. Defaults to 'kimi-k2' and 'hf-glm'.
+        fastest_response: Return only the first expert to answer successfully and cancel the rest.
+        use_cache: Set to False to get fresh answers instead of cached ones.
     """
-    results = []
-    for alias in experts:
-        res = ask_expert(prompt, model=alias, context_files=context_files)
-        results.append(f"## Expert: {alias.upper()}\n\n{res}\n")
-            
-    return "\n---".join(results)
+    context_files = context_files or ()
+    experts = experts or DEFAULT_EXPERTS
+
+    # Context is identical for every expert, so read the files only once
+    messages = _build_messages(prompt, _read_context_files(context_files))
+
+    # Each call is bounded by its provider's semaphore, see PROVIDER_CONCURRENCY
+    if fastest_response:
+        # A truncated answer must not win the race and cancel the complete ones
+        pending = {
+            asyncio.create_task(_run_completion(alias, messages, use_cache=use_cache, allow_partial=False)): alias
+            for alias in experts
+        }
+        errors = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    alias = pending.pop(task)
+                    if task.exception() is None:
+                        return _format_expert_result(alias, task.result())
+                    errors.append(_format_expert_result(alias, task.exception()))
+        finally:
+            for task in pending:
+                task.cancel()
+        # Every expert failed, report all of them
+        return "\n---".join(errors)
+
+    responses = await asyncio.gather(*(_run_completion(alias, messages, use_cache=use_cache) for alias in experts), return_exceptions=True)
+    return "\n---".join(_format_expert_result(alias, res) for alias, res in zip(experts, responses))
 
 def _clean_code_block(content: str) -> str:
     """Removes markdown code fences if present."""
@@ -147,8 +517,24 @@ def _clean_code_block(content: str) -> str:
             content = content[:-3]
     return content.strip()
 
+def _write_atomic(path: Path, content: str) -> None:
+    """Writes a file via a synced temp sibling and a rename, so a crash never leaves it half written."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    data = memoryview(content.encode("utf-8"))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, path)
+
 @mcp.tool()
-def draft_editor(file_path: str, instruction: str, model: str = "kimi-k2", context_files: List[str] = []) -> str:
+async def draft_editor(file_path: str, instruction: str, model: str = "kimi-k2", context_files: Optional[List[str]] = None) -> str:
     """
     Ask an expert model to rewrite a file based on instructions.
     Saves the result to {file_path}.draft for review.
@@ -159,6 +545,7 @@ def draft_editor(file_path: str, instruction: str, model: str = "kimi-k2", conte
         model: Expert alias (default: kimi-k2).
         context_files: Additional context files (optional).
     """
+    context_files = context_files or ()
     resolved_model = _resolve_model_name(model)
     target_path = Path(file_path).resolve()
     
@@ -168,20 +555,19 @@ def draft_editor(file_path: str, instruction: str, model: str = "kimi-k2", conte
     print(f"[External Brain] Editing {target_path} with {resolved_model}...", file=sys.stderr)
     
     # Read the target file content
+    # Decoded strictly (and not size capped like context files): the draft replaces this
+    # file, so a lossy decode would silently corrupt it
     try:
         current_content = target_path.read_text(encoding="utf-8")
     except Exception as e:
         return f"Error reading target file: {str(e)}"
     
     # Prepare Context (Target file + Extras)
-    # We treat the target file specially in the prompt
+    # We treat the target file specially in the prompt, so don't send it twice
+    context_files = [p for p in context_files if Path(p).resolve() != target_path]
     additional_context = _read_context_files(context_files)
     
-    system_prompt = (
-        "You are an elite software engineer. You are rewriting a file to meet user requirements.\n"
-        "Output ONLY the new content of the file. Do not output markdown code fences. Do not output conversational text.\n"
-        f"Additional Context from other files:\n{additional_context}"
-    )
+    system_prompt = _DRAFT_SYS_PREFIX + additional_context
     
     user_prompt = (
         f"--- ORIGINAL FILE: {target_path.name} ---\n"
@@ -192,20 +578,22 @@ def draft_editor(file_path: str, instruction: str, model: str = "kimi-k2", conte
     )
 
     try:
-        response = litellm.completion(
-            model=resolved_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1 # Very low temp for precision
-        )
+        # Shares the provider limits and rate limit backoff with the expert tools
+        async with _provider_semaphore(resolved_model):
+            response = await _acompletion_with_backoff(
+                model=resolved_model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=0.1 # Very low temp for precision
+            )
         
         # Process and Save
         new_content = _clean_code_block(response.choices[0].message.content)
         
         draft_path = target_path.with_suffix(target_path.suffix + ".draft")
-        draft_path.write_text(new_content, encoding="utf-8")
+        _write_atomic(draft_path, new_content)
         
         return f"Draft saved to: {draft_path}\nReview it and apply if correct."
         
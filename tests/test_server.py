@@ -1,27 +1,58 @@
 """
 Unit tests for external_models_mcp/server.py
 """
+import asyncio
 import os
+import subprocess
 import sys
 import tempfile
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+import httpx
+import litellm
 import pytest
 
 # Ensure the src directory is in the path for imports
 sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
 
 from external_models_mcp.server import (
+    _clean_code_block,
     _resolve_model_name,
     _read_context_files,
     ask_expert,
     compare_experts,
+    draft_editor,
+    mcp,
+    _get_cached_response,
+    _get_litellm,
+    _lifespan,
+    _put_cached_response,
+    _rate_limit_delay,
     MODEL_ALIASES,
     MAX_FILE_SIZE_BYTES,
-    MAX_TOTAL_CHARS
+    MAX_TOTAL_CHARS,
+    RATE_LIMIT_MAX_ATTEMPTS,
+    RATE_LIMIT_MAX_BACKOFF_SECONDS,
 )
 
 
+def _stream(*pieces: str):
+    """Fakes the async chunk iterator litellm returns for stream=True."""
+    async def _chunks():
+        for piece in pieces:
+            yield MagicMock(choices=[MagicMock(delta=MagicMock(content=piece))])
+    return _chunks()
+
+
+@pytest.fixture(autouse=True)
+def isolated_response_cache(tmp_path, monkeypatch):
+    """Keep cached model responses out of the user's home and between tests."""
+    monkeypatch.delenv("EXTERNAL_MODELS_NO_CACHE", raising=False)
+    monkeypatch.setattr("external_models_mcp.server._last_cache_prune", 0.0)
+    with patch("external_models_mcp.server.RESPONSE_CACHE_DIR", tmp_path / "responses"):
+        yield tmp_path / "responses"
+
+
 # --------------- _resolve_model_name tests --------------- #
 @pytest.mark.parametrize("alias,expected", [
     ("glm", MODEL_ALIASES["glm"]),
@@ -36,6 +67,21 @@ def test_resolve_model_name(alias: str, expected: str):
 
 
 # --------------- _read_context_files tests --------------- #
+def test_read_context_files_empty():
+    with patch("external_models_mcp.server._get_read_executor") as mock_executor:
+        assert _read_context_files(()) == ""
+    mock_executor.assert_not_called()
+
+
+def test_read_context_files_few_files_read_inline():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file1 = Path(tmpdir) / "a.py"
+        file1.write_text("a = 1", encoding="utf-8")
+        with patch("external_models_mcp.server._get_read_executor") as mock_executor:
+            assert "a = 1" in _read_context_files([str(file1)] * 3)
+        mock_executor.assert_not_called()
+
+
 def test_read_context_files_nonexistent_file():
     assert _read_context_files(["/nonexistent/path"]) == ""
 
@@ -59,6 +105,17 @@ def test_read_context_files_large_file():
     os.unlink(tmp.name)
 
 
+def test_read_context_files_large_file_not_opened():
+    with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
+        tmp.write("x" * (MAX_FILE_SIZE_BYTES + 1))
+        tmp.flush()
+        with patch("external_models_mcp.server.os.open") as mock_open:
+            content = _read_context_files([tmp.name])
+        mock_open.assert_not_called()
+        assert "too large" in content
+    os.unlink(tmp.name)
+
+
 def test_read_context_files_valid_content():
     with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".py") as tmp:
         tmp.write("print('hello world')")
@@ -71,6 +128,75 @@ def test_read_context_files_valid_content():
     os.unlink(tmp.name)
 
 
+def test_read_context_files_empty_file():
+    with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".py") as tmp:
+        content = _read_context_files([tmp.name])
+        assert content == f"<file path='{Path(tmp.name).resolve()}'>\n\n</file>"
+    os.unlink(tmp.name)
+
+
+@pytest.mark.skipif(not Path("/proc/self/status").exists(), reason="needs procfs")
+def test_read_context_files_pseudo_file():
+    # procfs reports a size of 0 but still has content
+    content = _read_context_files(["/proc/self/status"])
+    assert content.startswith("<file path='/proc/")
+    assert "Pid:" in content
+
+
+def test_read_context_files_unsized_file_too_large():
+    with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmp:
+        tmp.write("x" * (MAX_FILE_SIZE_BYTES + 1))
+        tmp.flush()
+        # Pretend the file doesn't report its size, like a pseudo file
+        unsized = os.stat_result((0o100644, 0, 0, 1, 0, 0, 0, 0, 0, 0))
+        with (
+            patch("external_models_mcp.server._READ_CHUNK_BYTES", 1024),
+            patch("external_models_mcp.server._load_file_text") as mock_load,
+            patch("external_models_mcp.server.os.stat", return_value=unsized),
+        ):
+            content = _read_context_files([tmp.name])
+        mock_load.assert_not_called()
+        assert "<error" in content and "too large" in content
+    os.unlink(tmp.name)
+
+
+@pytest.mark.parametrize("data,expected", [
+    (b"\x00\x01\x02", "Skipped binary file"),
+    # The two-byte character straddles the first read and later chunk boundaries
+    ("abc\u00e9" * 300, "abc\u00e9" * 300),
+])
+def test_read_context_files_unsized_file_chunks(data, expected):
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        tmp.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+        tmp.flush()
+        unsized = os.stat_result((0o100644, 0, 0, 1, 0, 0, 0, 0, 0, 0))
+        with (
+            patch("external_models_mcp.server._READ_CHUNK_BYTES", 3),
+            patch("external_models_mcp.server.os.stat", return_value=unsized),
+        ):
+            content = _read_context_files([tmp.name])
+        assert expected in content
+    os.unlink(tmp.name)
+
+
+def test_read_context_files_empty_file_no_read_buffer():
+    with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".py") as tmp:
+        with patch("external_models_mcp.server.bytearray", create=True) as mock_bytearray:
+            content = _read_context_files([tmp.name])
+        mock_bytearray.assert_not_called()
+        assert content == f"<file path='{Path(tmp.name).resolve()}'>\n\n</file>"
+    os.unlink(tmp.name)
+
+
+def test_read_context_files_invalid_utf8():
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".txt") as tmp:
+        tmp.write(b"caf\xe9")
+        tmp.flush()
+        content = _read_context_files([tmp.name])
+        assert "caf\ufffd" in content
+    os.unlink(tmp.name)
+
+
 def test_read_context_files_multiple_files():
     with tempfile.TemporaryDirectory() as tmpdir:
         file1 = Path(tmpdir) / "a.py"
@@ -81,6 +207,24 @@ def test_read_context_files_multiple_files():
         content = _read_context_files([str(file1), str(file2)])
         assert "a = 1" in content
         assert "b = 2" in content
+        assert content == (
+            f"<file path='{file1.resolve()}'>\na = 1\n</file>\n\n"
+            f"<file path='{file2.resolve()}'>\nb = 2\n</file>"
+        )
+
+
+def test_read_context_files_preserves_order():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(40):
+            path = Path(tmpdir) / f"f{i}.py"
+            path.write_bytes(b"\x00" if i % 7 == 0 else f"value_{i} = {i}".encode())
+            paths.append(str(path))
+
+        content = _read_context_files(paths)
+        positions = [content.index(f"f{i}.py'") for i in range(40)]
+        assert positions == sorted(positions)
+        assert content.count("Skipped binary file") == 6
 
 
 def test_read_context_files_total_char_limit():
@@ -95,13 +239,27 @@ def test_read_context_files_total_char_limit():
         assert "Context limit reached" in content
 
 
+def test_read_context_files_cached_until_modified():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file1 = Path(tmpdir) / "a.py"
+        file1.write_text("a = 1", encoding="utf-8")
+        assert "a = 1" in _read_context_files([str(file1)])
+
+        # Unchanged file is served from the cache without being opened
+        with patch("external_models_mcp.server.os.open") as mock_open:
+            assert "a = 1" in _read_context_files([str(file1)])
+        mock_open.assert_not_called()
+
+        # A new size/mtime misses the cache
+        file1.write_text("a = 22", encoding="utf-8")
+        assert "a = 22" in _read_context_files([str(file1)])
+
+
 # --------------- ask_expert tests --------------- #
-@patch("external_models_mcp.server.litellm.completion")
+@patch("litellm.acompletion", new_callable=AsyncMock)
 def test_ask_expert_no_context(mock_completion):
-    mock_completion.return_value = MagicMock(
-        choices=[MagicMock(message=MagicMock(content="mocked response"))]
-    )
-    result = ask_expert("What is 2+2?")
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
+    result = asyncio.run(ask_expert("What is 2+2?"))
     assert result == "mocked response"
     mock_completion.assert_called_once()
     call_args = mock_completion.call_args
@@ -113,15 +271,13 @@ def test_ask_expert_no_context(mock_completion):
     assert messages[0]["content"] == "What is 2+2?"
 
 
-@patch("external_models_mcp.server.litellm.completion")
+@patch("litellm.acompletion", new_callable=AsyncMock)
 def test_ask_expert_with_context(mock_completion):
-    mock_completion.return_value = MagicMock(
-        choices=[MagicMock(message=MagicMock(content="mocked response"))]
-    )
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
     with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".py") as tmp:
         tmp.write("def hello(): pass")
         tmp.flush()
-        result = ask_expert("Explain this code", context_files=[tmp.name])
+        result = asyncio.run(ask_expert("Explain this code", context_files=[tmp.name]))
         assert result == "mocked response"
         messages = mock_completion.call_args.kwargs["messages"]
         assert len(messages) == 2
@@ -132,37 +288,410 @@ def test_ask_expert_with_context(mock_completion):
     os.unlink(tmp.name)
 
 
-@patch("external_models_mcp.server.litellm.completion")
+@patch("litellm.acompletion", new_callable=AsyncMock)
 def test_ask_expert_model_alias(mock_completion):
-    mock_completion.return_value = MagicMock(
-        choices=[MagicMock(message=MagicMock(content="mocked response"))]
-    )
-    ask_expert("Q", model="glm")
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
+    asyncio.run(ask_expert("Q", model="glm"))
     assert mock_completion.call_args.kwargs["model"] == MODEL_ALIASES["glm"]
 
 
-@patch("external_models_mcp.server.litellm.completion")
+@patch("litellm.acompletion", new_callable=AsyncMock)
 def test_ask_expert_litellm_error(mock_completion):
     mock_completion.side_effect = Exception("litellm broke")
-    result = ask_expert("Q")
+    result = asyncio.run(ask_expert("Q"))
     assert "Error using" in result and "litellm broke" in result
 
 
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_response_cache(mock_completion):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
+    assert asyncio.run(ask_expert("Q")) == "mocked response"
+    assert asyncio.run(ask_expert("Q")) == "mocked response"
+    mock_completion.assert_called_once()
+
+    # A different prompt or model is a different entry
+    asyncio.run(ask_expert("Q2"))
+    asyncio.run(ask_expert("Q", model="glm"))
+    assert mock_completion.call_count == 3
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_response_cache_expired(mock_completion, isolated_response_cache):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
+    asyncio.run(ask_expert("Q"))
+    (entry,) = isolated_response_cache.iterdir()
+    os.utime(entry, (0, 0))
+    asyncio.run(ask_expert("Q"))
+    assert mock_completion.call_count == 2
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_response_cache_bypass(mock_completion, monkeypatch):
+    answers = iter(["first", "second", "third"])
+    mock_completion.side_effect = lambda *args, **kwargs: _stream(next(answers))
+    assert asyncio.run(ask_expert("Q")) == "first"
+    # A fresh answer is requested, and replaces the cached one
+    assert asyncio.run(ask_expert("Q", use_cache=False)) == "second"
+    assert asyncio.run(ask_expert("Q")) == "second"
+
+    monkeypatch.setenv("EXTERNAL_MODELS_NO_CACHE", "1")
+    assert asyncio.run(ask_expert("Q")) == "third"
+
+
+def test_response_cache_prunes_expired_entries(isolated_response_cache):
+    isolated_response_cache.mkdir()
+    for name in ("old.txt", "other.txt", "old.123.tmp"):
+        (isolated_response_cache / name).write_text("stale answer", encoding="utf-8")
+        os.utime(isolated_response_cache / name, (0, 0))
+
+    # Reading an expired entry deletes it
+    assert _get_cached_response("old") is None
+    assert not (isolated_response_cache / "old.txt").exists()
+
+    # Writing prunes expired entries that are never read again, and orphaned temp files
+    _put_cached_response("new", "fresh answer")
+    assert sorted(p.name for p in isolated_response_cache.iterdir()) == ["new.txt"]
+
+
+def test_response_cache_prune_throttled(isolated_response_cache):
+    _put_cached_response("first", "answer")
+    (isolated_response_cache / "old.txt").write_text("stale answer", encoding="utf-8")
+    os.utime(isolated_response_cache / "old.txt", (0, 0))
+
+    # The directory was already scanned on the first write, so later writes skip it
+    with patch("os.scandir") as mock_scandir:
+        _put_cached_response("second", "answer")
+    mock_scandir.assert_not_called()
+    assert (isolated_response_cache / "old.txt").exists()
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_errors_not_cached(mock_completion, isolated_response_cache):
+    mock_completion.side_effect = Exception("litellm broke")
+    asyncio.run(ask_expert("Q"))
+    assert not isolated_response_cache.exists()
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_streams(mock_completion):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("def ", None, "f(): pass")
+    assert asyncio.run(ask_expert("Q")) == "def f(): pass"
+    assert mock_completion.call_args.kwargs["stream"] is True
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_stream_interrupted(mock_completion, isolated_response_cache):
+    async def _broken_stream():
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content="partial answer"))])
+        raise Exception("connection reset")
+
+    mock_completion.side_effect = lambda *args, **kwargs: _broken_stream()
+    result = asyncio.run(ask_expert("Q"))
+    assert result.startswith("partial answer")
+    assert "connection reset" in result
+    # Partial answers are never cached
+    assert not isolated_response_cache.exists()
+
+
+def _rate_limit_error(retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    return litellm.RateLimitError(
+        message="slow down",
+        llm_provider="groq",
+        model="kimi",
+        response=httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://example.com")),
+    )
+
+
+@pytest.mark.parametrize("retry_after,attempt,expected", [
+    (None, 1, 1),
+    (None, 3, 4),
+    (None, 10, RATE_LIMIT_MAX_BACKOFF_SECONDS),
+    ("7", 1, 7),
+    ("3600", 1, RATE_LIMIT_MAX_BACKOFF_SECONDS),
+])
+def test_rate_limit_delay(retry_after, attempt, expected):
+    assert _rate_limit_delay(_rate_limit_error(retry_after), attempt) == expected
+
+
+@patch("external_models_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_retries_rate_limits(mock_completion, mock_sleep):
+    responses = [_rate_limit_error("2"), _rate_limit_error(), _stream("finally")]
+
+    def side_effect(*args, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    mock_completion.side_effect = side_effect
+    assert asyncio.run(ask_expert("Q")) == "finally"
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [2, 2]
+
+
+@patch("external_models_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_rate_limit_gives_up(mock_completion, mock_sleep):
+    mock_completion.side_effect = _rate_limit_error()
+    result = asyncio.run(ask_expert("Q"))
+    assert "Error using" in result and "slow down" in result
+    assert mock_completion.call_count == RATE_LIMIT_MAX_ATTEMPTS
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_ask_expert_echoes_whole_lines(mock_completion, capsys):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("def f():\n    ret", "urn 1\n", "f()")
+    asyncio.run(ask_expert("Q"))
+    model = MODEL_ALIASES["kimi-k2"]
+    echoed = [line for line in capsys.readouterr().err.splitlines() if line.startswith(f"[{model}]")]
+    assert echoed == [f"[{model}] def f():", f"[{model}]     return 1", f"[{model}] f()"]
+
+
 # --------------- compare_experts tests --------------- #
-@patch("external_models_mcp.server.litellm.completion")
+@patch("litellm.acompletion", new_callable=AsyncMock)
 def test_compare_experts(mock_completion):
     def side_effect(*args, **kwargs):
         model = kwargs.get("model", "")
         if "moonshot" in model: # Kimi matches openrouter/moonshot...
-            return MagicMock(choices=[MagicMock(message=MagicMock(content="kimi says"))])
+            return _stream("kimi says")
         if "glm" in model: # GLM matches ...glm...
-            return MagicMock(choices=[MagicMock(message=MagicMock(content="glm says"))])
-        return MagicMock(choices=[MagicMock(message=MagicMock(content="other"))])
+            return _stream("glm says")
+        return _stream("other")
 
     mock_completion.side_effect = side_effect
     # Use actual aliases from the map to ensure mock catches them
-    result = compare_experts("Compare", experts=["kimi", "glm"])
+    result = asyncio.run(compare_experts("Compare", experts=["kimi", "glm"]))
     assert "Expert: KIMI" in result
     assert "kimi says" in result
     assert "Expert: GLM" in result
     assert "glm says" in result
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_runs_concurrently(mock_completion):
+    in_flight = 0
+    peak = 0
+
+    async def side_effect(*args, **kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        # The slower first expert must still be reported first
+        await asyncio.sleep(0.05 if "glm" in kwargs["model"] else 0.01)
+        in_flight -= 1
+        return _stream(f"{kwargs['model']} says")
+
+    mock_completion.side_effect = side_effect
+    result = asyncio.run(compare_experts("Compare", experts=["glm", "kimi"]))
+    assert peak == 2
+    assert result.index("Expert: GLM") < result.index("Expert: KIMI")
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_fastest_response(mock_completion):
+    async def side_effect(*args, **kwargs):
+        if "glm" in kwargs["model"]:
+            await asyncio.sleep(1)
+            return _stream("glm says")
+        if "minimax" in kwargs["model"]:
+            raise Exception("minimax broke")
+        await asyncio.sleep(0.01)
+        return _stream("kimi says")
+
+    mock_completion.side_effect = side_effect
+    result = asyncio.run(compare_experts("Compare", experts=["glm", "minimax", "kimi"], fastest_response=True))
+    assert result == "## Expert: KIMI\n\nkimi says\n"
+
+
+@patch("external_models_mcp.server._read_context_files", return_value="<file path='a.py'>\na = 1\n</file>")
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_reads_context_once(mock_completion, mock_read):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream("mocked ", "response")
+    asyncio.run(compare_experts("Compare", context_files=["a.py"], experts=["kimi", "glm", "minimax"]))
+    assert mock_read.call_count == 1
+    assert mock_completion.call_count == 3
+    for call in mock_completion.call_args_list:
+        assert "a = 1" in call.kwargs["messages"][0]["content"]
+
+
+@patch.dict("external_models_mcp.server._PROVIDER_SEMAPHORES", clear=True)
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_bounded_per_provider(mock_completion):
+    in_flight = 0
+    peak = 0
+
+    async def _slow_stream(model):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content=f"{model} says"))])
+
+    mock_completion.side_effect = lambda *args, **kwargs: _slow_stream(kwargs["model"])
+    # Three Hugging Face experts share that provider's limit of 2
+    result = asyncio.run(compare_experts("Compare", experts=["hf-glm", "hf-kimi", "hf-minimax"]))
+    assert peak == 2
+    assert result.count("## Expert:") == 3
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_default_experts(mock_completion):
+    mock_completion.side_effect = lambda *args, **kwargs: _stream(f"{kwargs['model']} says")
+    result = asyncio.run(compare_experts("Compare"))
+    assert "Expert: KIMI-K2" in result
+    assert "Expert: HF-GLM" in result
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_fastest_response_ignores_partial(mock_completion):
+    async def _broken_stream():
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content="partial"))])
+        raise Exception("connection reset")
+
+    async def _slow_stream():
+        await asyncio.sleep(0.05)
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content="complete answer"))])
+
+    mock_completion.side_effect = lambda *args, **kwargs: (
+        _broken_stream() if "glm" in kwargs["model"] else _slow_stream()
+    )
+    result = asyncio.run(compare_experts("Compare", experts=["glm", "kimi"], fastest_response=True))
+    assert result == "## Expert: KIMI\n\ncomplete answer\n"
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_compare_experts_fastest_response_ignores_empty(mock_completion):
+    async def _slow_stream():
+        await asyncio.sleep(0.05)
+        yield MagicMock(choices=[MagicMock(delta=MagicMock(content="real answer"))])
+
+    mock_completion.side_effect = lambda *args, **kwargs: (
+        _stream(None) if "glm" in kwargs["model"] else _slow_stream()
+    )
+    result = asyncio.run(compare_experts("Compare", experts=["glm", "kimi"], fastest_response=True))
+    assert result == "## Expert: KIMI\n\nreal answer\n"
+
+
+# --------------- _clean_code_block tests --------------- #
+@pytest.mark.parametrize("content,expected", [
+    ("a = 1", "a = 1"),
+    ("  a = 1\n", "a = 1"),
+    ("```python\na = 1\n```", "a = 1"),
+    ("```\na = 1\nb = 2\n```\n", "a = 1\nb = 2"),
+    ("\n```py\na = 1", "a = 1"),
+    ("```python\ns = '```'\n```", "s = '```'"),
+    ("```python", "```python"),
+    ("```", ""),
+])
+def test_clean_code_block(content: str, expected: str):
+    assert _clean_code_block(content) == expected
+
+
+# --------------- draft_editor tests --------------- #
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_writes_draft(mock_completion):
+    mock_completion.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="```python\na = 2\n```"))]
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "a.py"
+        target.write_text("a = 1", encoding="utf-8")
+        result = asyncio.run(draft_editor(str(target), "Set a to 2"))
+        assert "Draft saved to" in result
+        assert (Path(tmpdir) / "a.py.draft").read_text(encoding="utf-8") == "a = 2"
+        assert "a = 1" in mock_completion.call_args.kwargs["messages"][1]["content"]
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_target_not_repeated_in_context(mock_completion):
+    mock_completion.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="a = 2"))]
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "a.py"
+        target.write_text("a = 1", encoding="utf-8")
+        other = Path(tmpdir) / "b.py"
+        other.write_text("b = 1", encoding="utf-8")
+        asyncio.run(draft_editor(str(target), "Set a to 2", context_files=[str(target), str(other)]))
+
+        system_prompt, user_prompt = (m["content"] for m in mock_completion.call_args.kwargs["messages"])
+        assert "a = 1" not in system_prompt
+        assert "b = 1" in system_prompt
+        assert user_prompt.count("a = 1") == 1
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_non_utf8_target(mock_completion):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "a.txt"
+        target.write_bytes(b"caf\xe9")
+        result = asyncio.run(draft_editor(str(target), "Edit it"))
+        assert result.startswith("Error reading target file")
+        assert not (Path(tmpdir) / "a.txt.draft").exists()
+    mock_completion.assert_not_called()
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_large_target(mock_completion):
+    mock_completion.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="x"))]
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "big.txt"
+        # The context file size limit doesn't apply to the file being edited
+        target.write_text("x" * (MAX_FILE_SIZE_BYTES + 1), encoding="utf-8")
+        result = asyncio.run(draft_editor(str(target), "Shorten it"))
+        assert "Draft saved to" in result
+
+
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_replaces_existing_draft(mock_completion):
+    mock_completion.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="a = 3"))]
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "a.py"
+        target.write_text("a = 1", encoding="utf-8")
+        (Path(tmpdir) / "a.py.draft").write_text("a = 2 and much longer old draft", encoding="utf-8")
+        asyncio.run(draft_editor(str(target), "Set a to 3"))
+        assert (Path(tmpdir) / "a.py.draft").read_text(encoding="utf-8") == "a = 3"
+        # The temporary sibling is renamed away, not left behind
+        assert sorted(p.name for p in Path(tmpdir).iterdir()) == ["a.py", "a.py.draft"]
+
+
+@patch("external_models_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+@patch("litellm.acompletion", new_callable=AsyncMock)
+def test_draft_editor_retries_rate_limits(mock_completion, mock_sleep):
+    mock_completion.side_effect = [
+        _rate_limit_error("3"),
+        MagicMock(choices=[MagicMock(message=MagicMock(content="a = 2"))]),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        target = Path(tmpdir) / "a.py"
+        target.write_text("a = 1", encoding="utf-8")
+        result = asyncio.run(draft_editor(str(target), "Set a to 2"))
+        assert "Draft saved to" in result
+        assert (Path(tmpdir) / "a.py.draft").read_text(encoding="utf-8") == "a = 2"
+    mock_sleep.assert_awaited_once_with(3)
+
+
+# --------------- server lifespan tests --------------- #
+def test_lifespan_shares_pooled_client():
+    async def _run():
+        async with _lifespan(mcp):
+            client = _get_litellm().aclient_session
+            assert isinstance(client, httpx.AsyncClient)
+            assert not client.is_closed
+        assert litellm.aclient_session is None
+        assert client.is_closed
+
+    asyncio.run(_run())
+
+
+def test_litellm_imported_lazily():
+    # LiteLLM is slow to import, the server must not load it until a model is called
+    code = "import sys; import external_models_mcp.server; assert 'litellm' not in sys.modules"
+    src = str(Path(__file__).parents[1] / "src")
+    subprocess.run([sys.executable, "-c", code], check=True, env={**os.environ, "PYTHONPATH": src})